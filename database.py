@@ -5,7 +5,8 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from redis.asyncio import Redis
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -22,11 +23,41 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Motor connects lazily, so the client can be built at import; init_client() verifies it at startup
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=100,
+        minPoolSize=10,
+        waitQueueTimeoutMS=2000,
+        retryWrites=True,
+        compressors="zstd",
+    )
     db = _client[database_name]
 
+# Optional Redis holding live match state between Mongo flushes
+redis_db = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    redis_db = Redis.from_url(redis_url, decode_responses=True)
+
+async def init_client():
+    """Check that the configured databases are reachable"""
+    if db is not None:
+        await db.command("ping")
+    if redis_db is not None:
+        await redis_db.ping()
+
+async def close_client():
+    """Close database connections"""
+    if _client is not None:
+        _client.close()
+    if redis_db is not None:
+        await redis_db.aclose()
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,10 +71,10 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +83,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
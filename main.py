@@ -1,29 +1,47 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
 import os
 import time
-from fastapi import FastAPI, HTTPException
+import weakref
+from functools import lru_cache
+import orjson
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from redis.exceptions import WatchError
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Literal, Optional
 
-from database import db, create_document, get_documents
-from schemas import Player, Card, Match, Unit, Tower
+from database import db, redis_db, create_document, init_client, close_client
+from schemas import Player, Card
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Comma-separated list of allowed frontend origins; no credentials, and preflights cached for a day
+frontend_origins = [o.strip() for o in os.getenv("FRONTEND_ORIGIN", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=frontend_origins,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,
 )
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Battle Arena API running"}
 
 @app.get("/schema")
-def get_schema_overview():
+async def get_schema_overview():
     # helper endpoint for viewers
     return {
         "collections": ["player", "card", "match"],
@@ -34,69 +52,353 @@ COLLECTION_PLAYER = "player"
 COLLECTION_CARD = "card"
 COLLECTION_MATCH = "match"
 
-# Seed some cards if empty
+@lru_cache(maxsize=4096)
+def oid(match_id: str) -> ObjectId:
+    return ObjectId(match_id)
+
+# Card catalog is static once seeded, so keep it in-process instead of re-reading it every tick
+CARDS_CACHE_TTL_S = 300
+_CARDS_CACHE: dict[str, dict] = {}
+_CARDS_CACHE_TS = 0.0
+_CARDS_JSON: Optional[bytes] = None
+_CARDS_ETAG: Optional[str] = None
+_TICK_PIPELINE: Optional[list] = None
+
+# Small-int card index with parallel speed/dmg tables. Seeded cards carry a stable idx on their
+# document, which deploy_unit stores on units as card_idx; cards without one get an in-memory slot
+# after the stored ones, used only to resolve units by card_id. The trailing entry holds the defaults
+# so an unknown card (idx -1) needs no branch
+CARD_IDX: dict[str, int] = {}
+CARD_SPEEDS: list[float] = [1.0]
+CARD_DMGS: list[int] = [50]
+
+def load_card_tables(cards: dict[str, dict]):
+    global CARD_IDX, CARD_SPEEDS, CARD_DMGS
+    card_idx = {card_id: c["idx"] for card_id, c in cards.items() if c.get("idx") is not None}
+    next_idx = max(card_idx.values(), default=-1) + 1
+    for card_id in cards:
+        if card_id not in card_idx:
+            card_idx[card_id] = next_idx
+            next_idx += 1
+    speeds, dmgs = [1.0] * (next_idx + 1), [50] * (next_idx + 1)
+    for card_id, i in card_idx.items():
+        speeds[i] = cards[card_id].get("speed", 1.0)
+        dmgs[i] = int(cards[card_id].get("dmg", 50))
+    CARD_IDX, CARD_SPEEDS, CARD_DMGS = card_idx, speeds, dmgs
+
+async def get_cards_map() -> dict[str, dict]:
+    global _CARDS_CACHE, _CARDS_CACHE_TS, _CARDS_JSON, _TICK_PIPELINE
+    if not _CARDS_CACHE or time.monotonic() - _CARDS_CACHE_TS > CARDS_CACHE_TTL_S:
+        cards = {}
+        async for c in db[COLLECTION_CARD].find({}):
+            c["_id"] = str(c["_id"])  # stringify
+            cards[c["card_id"]] = c
+        load_card_tables(cards)
+        _CARDS_CACHE = cards
+        _CARDS_CACHE_TS = time.monotonic()
+        _CARDS_JSON = None
+        _TICK_PIPELINE = None
+    return _CARDS_CACHE
+
+def invalidate_cards_cache():
+    global _CARDS_CACHE
+    # get_cards_map reloads whenever the cache is empty
+    _CARDS_CACHE = {}
+
+# Live match state in Redis (when REDIS_URL is set): a hash of scalar fields plus a list of
+# unit JSON per match. Mutated matches are flagged dirty and flushed back to Mongo periodically.
+MATCH_FLUSH_INTERVAL_S = 5
+# Live keys outlive the 180s match by a wide margin, so abandoned matches still age out of Redis
+LIVE_MATCH_TTL_S = 3600
+# WATCH retries for a tick racing deploys from other workers
+LIVE_TICK_RETRIES = 3
+_DIRTY_MATCHES_KEY = "match:dirty"
+_flush_task: Optional[asyncio.Task] = None
+
+# Per-match locks; entries disappear once no request holds them
+_match_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def lock_for(match_id: str) -> asyncio.Lock:
+    lock = _match_locks.get(match_id)
+    if lock is None:
+        lock = _match_locks[match_id] = asyncio.Lock()
+    return lock
+
+def _match_key(match_id: str) -> str:
+    return f"match:{match_id}"
+
+def _units_key(match_id: str) -> str:
+    return f"match:{match_id}:units"
+
+def _queue_live_touch(pipe, match_id: str):
+    # rev orders snapshots so a stale flush can't overwrite a newer one in Mongo
+    pipe.hincrby(_match_key(match_id), "rev", 1)
+    pipe.expire(_match_key(match_id), LIVE_MATCH_TTL_S)
+    pipe.expire(_units_key(match_id), LIVE_MATCH_TTL_S)
+    pipe.sadd(_DIRTY_MATCHES_KEY, match_id)
+
+def _queue_live_write(pipe, match_id: str, match: dict):
+    pipe.hset(_match_key(match_id), mapping={
+        "elixir": match["elixir"],
+        "time": match["time"],
+        "last_tick_ms": match["last_tick_ms"],
+        "status": match["status"],
+        "towers": orjson.dumps(match["towers"]),
+    })
+    pipe.delete(_units_key(match_id))
+    if match["units"]:
+        pipe.rpush(_units_key(match_id), *[orjson.dumps(u) for u in match["units"]])
+    _queue_live_touch(pipe, match_id)
+
+# Check and spend elixir, push the unit and mark the match dirty in one step, so the hash can't expire
+# or be evicted between the check and the write (which would recreate a partial match)
+_DEPLOY_LIVE_LUA = """
+local elixir = redis.call('HGET', KEYS[1], 'elixir')
+if not elixir then return -1 end
+if tonumber(elixir) < tonumber(ARGV[1]) then return 0 end
+redis.call('HINCRBYFLOAT', KEYS[1], 'elixir', -tonumber(ARGV[1]))
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'rev', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('SADD', KEYS[3], ARGV[4])
+return 1
+"""
+
+# Drop ids from the dirty set only if their rev is still the one that was flushed (or the match is
+# gone); KEYS[1] is the dirty set, KEYS[i+1] the match hash for ARGV[i], ARGV[n+i] its flushed rev
+_CLEAR_DIRTY_LUA = """
+local n = #KEYS - 1
+for i = 1, n do
+    local rev = redis.call('HGET', KEYS[i + 1], 'rev')
+    if not rev or rev == ARGV[n + i] then
+        redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+return 0
+"""
+
+_deploy_live = redis_db.register_script(_DEPLOY_LIVE_LUA) if redis_db is not None else None
+_clear_dirty = redis_db.register_script(_CLEAR_DIRTY_LUA) if redis_db is not None else None
+
+async def deploy_live_unit(match_id: str, cost: int, unit: dict) -> Optional[bool]:
+    """Deploy onto a match held in Redis; None when the match is not live there, False when short on elixir"""
+    res = await _deploy_live(
+        keys=[_match_key(match_id), _units_key(match_id), _DIRTY_MATCHES_KEY],
+        args=[cost, orjson.dumps(unit), LIVE_MATCH_TTL_S, match_id],
+    )
+    return None if res == -1 else res == 1
+
+async def clear_dirty_matches(flushed: dict[str, str]):
+    match_ids = list(flushed)
+    await _clear_dirty(
+        keys=[_DIRTY_MATCHES_KEY, *[_match_key(match_id) for match_id in match_ids]],
+        args=[*match_ids, *[flushed[match_id] for match_id in match_ids]],
+    )
+
+async def save_live_match(match_id: str, match: dict):
+    async with redis_db.pipeline(transaction=True) as pipe:
+        _queue_live_write(pipe, match_id, match)
+        await pipe.execute()
+
+def _parse_live_match(state: dict, units: list) -> Optional[dict]:
+    if not state:
+        return None
+    return {
+        "elixir": float(state["elixir"]),
+        "time": int(state["time"]),
+        "last_tick_ms": int(state["last_tick_ms"]),
+        "status": state["status"],
+        "towers": orjson.loads(state["towers"]),
+        "units": [orjson.loads(u) for u in units],
+    }
+
+async def load_live_match(match_id: str) -> Optional[dict]:
+    async with redis_db.pipeline(transaction=False) as pipe:
+        pipe.hgetall(_match_key(match_id))
+        pipe.lrange(_units_key(match_id), 0, -1)
+        state, units = await pipe.execute()
+    return _parse_live_match(state, units)
+
+async def flush_live_matches(match_ids: list[str], evict: bool = False) -> dict[str, str]:
+    """Write live Redis state back to the Mongo match documents; returns the rev flushed per id"""
+    async with redis_db.pipeline(transaction=False) as pipe:
+        for match_id in match_ids:
+            pipe.hgetall(_match_key(match_id))
+            pipe.lrange(_units_key(match_id), 0, -1)
+        replies = await pipe.execute()
+    ops = []
+    flushed = {}
+    for match_id, state, units in zip(match_ids, replies[::2], replies[1::2]):
+        flushed[match_id] = state.get("rev", "")
+        live = _parse_live_match(state, units)
+        if live is None:
+            continue
+        rev = int(state.get("rev", 0))
+        live["live_rev"] = rev
+        # skip the write if Mongo already holds this snapshot or a newer one
+        ops.append(UpdateOne(
+            {"_id": oid(match_id), "$or": [{"live_rev": {"$exists": False}}, {"live_rev": {"$lt": rev}}]},
+            {"$set": live},
+        ))
+    if ops:
+        await db[COLLECTION_MATCH].bulk_write(ops, ordered=False)
+    if evict:
+        await redis_db.delete(*[k for match_id in match_ids for k in (_match_key(match_id), _units_key(match_id))])
+    return flushed
+
+async def flush_dirty_matches():
+    while True:
+        await asyncio.sleep(MATCH_FLUSH_INTERVAL_S)
+        try:
+            # ids leave the dirty set only once the state they had is in Mongo
+            match_ids = await redis_db.srandmember(_DIRTY_MATCHES_KEY, 1000)
+            if match_ids:
+                await clear_dirty_matches(await flush_live_matches(match_ids))
+        except Exception:
+            logger.exception("Failed to flush live matches to Mongo")
+
+@app.on_event("startup")
+async def connect_databases():
+    await init_client()
+
+@app.on_event("startup")
+async def start_match_flusher():
+    global _flush_task
+    if db is None or redis_db is None:
+        return
+    _flush_task = asyncio.create_task(flush_dirty_matches())
+
+@app.on_event("shutdown")
+async def stop_match_flusher():
+    if _flush_task is None:
+        return
+    _flush_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await _flush_task
+    match_ids = list(await redis_db.smembers(_DIRTY_MATCHES_KEY))
+    if match_ids:
+        await clear_dirty_matches(await flush_live_matches(match_ids))
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    await db[COLLECTION_CARD].create_index("card_id", unique=True)
+    await db[COLLECTION_CARD].create_index("idx", unique=True, sparse=True)
+    await db[COLLECTION_MATCH].create_index("player_id")
+
+@app.on_event("shutdown")
+async def disconnect_databases():
+    await close_client()
+
+# Seed the base cards (idempotent)
 @app.post("/seed")
-def seed_cards():
+async def seed_cards():
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    existing = db[COLLECTION_CARD].count_documents({})
-    if existing > 0:
-        return {"ok": True, "seeded": False, "count": existing}
+    # idx is fixed per card here, so reseeding never renumbers cards that units already reference
     base_cards = [
-        Card(card_id="knight", name="Knight", cost=3, role="melee", hp=600, dmg=75, speed=1.0, range=1.0).model_dump(),
-        Card(card_id="archer", name="Archer", cost=3, role="ranged", hp=220, dmg=100, speed=1.0, range=4.0).model_dump(),
-        Card(card_id="giant", name="Giant", cost=5, role="tank", hp=2000, dmg=100, speed=0.6, range=1.0).model_dump(),
-        Card(card_id="assassin", name="Assassin", cost=4, role="assassin", hp=400, dmg=200, speed=1.5, range=1.0).model_dump(),
+        Card(card_id="knight", name="Knight", cost=3, role="melee", hp=600, dmg=75, speed=1.0, range=1.0, idx=0).model_dump(),
+        Card(card_id="archer", name="Archer", cost=3, role="ranged", hp=220, dmg=100, speed=1.0, range=4.0, idx=1).model_dump(),
+        Card(card_id="giant", name="Giant", cost=5, role="tank", hp=2000, dmg=100, speed=0.6, range=1.0, idx=2).model_dump(),
+        Card(card_id="assassin", name="Assassin", cost=4, role="assassin", hp=400, dmg=200, speed=1.5, range=1.0, idx=3).model_dump(),
     ]
-    db[COLLECTION_CARD].insert_many(base_cards)
-    return {"ok": True, "seeded": True, "count": len(base_cards)}
+    # the unique card_id index dedupes re-seeds, so already-present cards are skipped rather than checked upfront
+    try:
+        result = await db[COLLECTION_CARD].insert_many(base_cards, ordered=False, bypass_document_validation=True)
+        inserted = len(result.inserted_ids)
+    except BulkWriteError as e:
+        # only duplicate-key errors mean "already seeded"; anything else, including write concern failures, is real
+        if e.details.get("writeConcernErrors") or any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        inserted = e.details.get("nInserted", 0)
+        # cards seeded before idx existed get theirs backfilled
+        backfill = await db[COLLECTION_CARD].bulk_write([
+            UpdateOne({"card_id": c["card_id"], "idx": {"$exists": False}}, {"$set": {"idx": c["idx"]}})
+            for c in base_cards
+        ], ordered=False)
+        inserted += backfill.modified_count
+    if inserted:
+        invalidate_cards_cache()
+    # catalog size as stored, served from the card cache
+    return {"ok": True, "seeded": inserted > 0, "count": len(await get_cards_map())}
 
 class CreatePlayerRequest(BaseModel):
     username: str
 
 @app.post("/player", response_model=dict)
-def create_player(req: CreatePlayerRequest):
+async def create_player(req: CreatePlayerRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    existing = db[COLLECTION_PLAYER].find_one({"username": req.username})
+    existing = await db[COLLECTION_PLAYER].find_one({"username": req.username})
     if existing:
         return {"player_id": str(existing.get("_id")), "username": existing["username"]}
     player = Player(username=req.username)
-    player_id = create_document(COLLECTION_PLAYER, player)
+    player_id = await create_document(COLLECTION_PLAYER, player)
     return {"player_id": player_id, "username": req.username}
 
 @app.get("/cards")
-def list_cards():
+async def list_cards(request: Request):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    cards = get_documents(COLLECTION_CARD, {})
-    for c in cards:
-        c["_id"] = str(c["_id"])  # stringify
-    return {"cards": cards}
+    global _CARDS_JSON, _CARDS_ETAG
+    cards_map = await get_cards_map()
+    # serialized once per catalog refresh
+    if _CARDS_JSON is None:
+        _CARDS_JSON = orjson.dumps({"cards": list(cards_map.values())})
+        _CARDS_ETAG = f'"{hashlib.blake2b(_CARDS_JSON, digest_size=8).hexdigest()}"'
+    headers = {"ETag": _CARDS_ETAG, "Cache-Control": "public, max-age=60"}
+    if request.headers.get("if-none-match") == _CARDS_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=_CARDS_JSON, media_type="application/json", headers=headers)
+
+# Server-controlled starting towers, built once instead of validating Tower models per match
+_DEFAULT_TOWERS = [
+    {"side": side, "lane": lane, "hp": hp}
+    for (side, lane, hp) in (
+        ("player", "left", 1000),
+        ("player", "right", 1000),
+        ("player", "king", 1800),
+        ("ai", "left", 1000),
+        ("ai", "right", 1000),
+        ("ai", "king", 1800),
+    )
+]
 
 class StartMatchRequest(BaseModel):
     player_id: str
 
 @app.post("/match/start")
-def start_match(req: StartMatchRequest):
+async def start_match(req: StartMatchRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    match = Match(
-        player_id=req.player_id,
-        time=180,
-        elixir=5,
-        units=[],
-        towers=[
-            Tower(side="player", lane="left", hp=1000),
-            Tower(side="player", lane="right", hp=1000),
-            Tower(side="player", lane="king", hp=1800),
-            Tower(side="ai", lane="left", hp=1000),
-            Tower(side="ai", lane="right", hp=1000),
-            Tower(side="ai", lane="king", hp=1800),
-        ],
-        last_tick_ms=int(time.time() * 1000),
-    ).model_dump()
-    match_id = create_document(COLLECTION_MATCH, match)
+    match = {
+        "player_id": req.player_id,
+        "status": "active",
+        "time": 180,
+        "elixir": 5,
+        "units": [],
+        "towers": [t.copy() for t in _DEFAULT_TOWERS],
+    }
+    # insert through a pipeline upsert so last_tick_ms comes from Mongo's clock, the same one ticks use
+    match_oid = ObjectId()
+    doc = await db[COLLECTION_MATCH].find_one_and_update(
+        {"_id": match_oid},
+        [{"$set": {
+            **{k: {"$literal": v} for k, v in match.items()},
+            "last_tick_ms": _NOW_MS,
+            "created_at": "$$NOW",
+            "updated_at": "$$NOW",
+        }}],
+        projection={"last_tick_ms": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    match["last_tick_ms"] = doc["last_tick_ms"]
+    match_id = str(match_oid)
+    if redis_db is not None:
+        await save_live_match(match_id, match)
     return {"match_id": match_id, "state": match}
 
 class DeployRequest(BaseModel):
@@ -105,75 +407,267 @@ class DeployRequest(BaseModel):
     lane: int
 
 @app.post("/match/deploy")
-def deploy_unit(req: DeployRequest):
+async def deploy_unit(req: DeployRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    match = db[COLLECTION_MATCH].find_one({"_id": {"$eq": db[COLLECTION_MATCH].codec_options.uuid_representation and None}})
-    match = db[COLLECTION_MATCH].find_one({"_id": db[COLLECTION_MATCH].find_one({"_id": {"$exists": True}})["_id"]}) if False else db[COLLECTION_MATCH].find_one({"_id": __import__("bson").ObjectId(req.match_id)})
-    if not match:
-        raise HTTPException(status_code=404, detail="Match not found")
     # Simple elixir and deploy
-    unit_card = db[COLLECTION_CARD].find_one({"card_id": req.card_id})
+    unit_card = (await get_cards_map()).get(req.card_id)
     if not unit_card:
         raise HTTPException(status_code=404, detail="Card not found")
-    if match.get("elixir", 0) < unit_card["cost"]:
+    cost = unit_card["cost"]
+    unit = {"owner": "player", "card_id": req.card_id, "x": 0.0, "lane": req.lane, "hp": unit_card["hp"]}
+    if unit_card.get("idx") is not None:
+        unit["card_idx"] = unit_card["idx"]
+    if redis_db is not None:
+        deployed = await deploy_live_unit(req.match_id, cost, unit)
+        if deployed is False:
+            raise HTTPException(status_code=400, detail="Not enough elixir")
+        if deployed:
+            return {"ok": True}
+    # elixir check and spend in one atomic update
+    match = await db[COLLECTION_MATCH].find_one_and_update(
+        {"_id": oid(req.match_id), "elixir": {"$gte": cost}},
+        {"$push": {"units": unit}, "$inc": {"elixir": -cost}},
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not match:
+        if not await db[COLLECTION_MATCH].find_one({"_id": oid(req.match_id)}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Match not found")
         raise HTTPException(status_code=400, detail="Not enough elixir")
-    unit = Unit(owner="player", card_id=req.card_id, x=0.0, lane=req.lane, hp=unit_card["hp"]).model_dump()
-    db[COLLECTION_MATCH].update_one({"_id": match["_id"]}, {"$push": {"units": unit}, "$inc": {"elixir": -unit_card["cost"]}})
     return {"ok": True}
 
+MATCH_FIELDS = frozenset({"player_id", "status", "time", "elixir", "units", "towers", "last_tick_ms", "created_at", "updated_at"})
+
 @app.get("/match/state/{match_id}")
-def get_match_state(match_id: str):
+async def get_match_state(match_id: str, fields: Optional[str] = None):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    match = db[COLLECTION_MATCH].find_one({"_id": __import__("bson").ObjectId(match_id)})
+    # ?fields=elixir,time limits the read to those fields
+    projection = ({f.strip(): 1 for f in fields.split(",") if f.strip()} if fields else None) or None
+    if projection is not None:
+        unknown = sorted(set(projection) - MATCH_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    live = await load_live_match(match_id) if redis_db is not None else None
+    if live is None:
+        match = await db[COLLECTION_MATCH].find_one({"_id": oid(match_id)}, projection or {"live_rev": 0})
+    elif projection is not None and all(f in live for f in projection):
+        match = {"_id": match_id}
+    else:
+        # only the fields Redis doesn't hold (player_id, timestamps) come from Mongo
+        rest = {f: 1 for f in projection if f not in live} if projection is not None else {f: 0 for f in (*live, "live_rev")}
+        match = await db[COLLECTION_MATCH].find_one({"_id": oid(match_id)}, rest)
     if not match:
         raise HTTPException(status_code=404, detail="Match not found")
+    if live is not None:
+        match.update({k: v for k, v in live.items() if projection is None or k in projection})
     match["_id"] = str(match["_id"])
     return match
 
-@app.post("/match/tick/{match_id}")
-def tick(match_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not available")
-    from bson import ObjectId
-    match = db[COLLECTION_MATCH].find_one({"_id": ObjectId(match_id)})
-    if not match:
-        raise HTTPException(status_code=404, detail="Match not found")
-
-    # Advance simple simulation: move player units towards AI side and deduct time, regen elixir
-    now_ms = int(time.time() * 1000)
-    last = match.get("last_tick_ms", now_ms)
-    dt = max(0, now_ms - last)
+def advance_match(match: dict, now_ms: int):
+    """Advance a live match in place by the time elapsed since its last tick (mirrors tick_pipeline)"""
+    dt = max(0, now_ms - match.get("last_tick_ms", now_ms))
     # regen elixir: 1 elixir per 2800ms up to 10
-    regen = dt / 2800.0
-    new_elixir = min(10, match.get("elixir", 0) + regen)
-
-    units = match.get("units", [])
-    cards_map = {c["card_id"]: c for c in db[COLLECTION_CARD].find({})}
+    match["elixir"] = min(10, match.get("elixir", 0) + dt / 2800.0)
 
     # simple movement
-    for u in units:
-        card = cards_map.get(u["card_id"]) or {"speed": 1.0, "dmg": 50}
-        u["x"] = u.get("x", 0.0) + card.get("speed", 1.0) * (dt / 1000.0)
+    speeds, dmgs = CARD_SPEEDS, CARD_DMGS
+    n_cards = len(speeds) - 1
+    # resolve each unit lane to its AI tower once per tick: lane 2 -> right, anything else -> left
+    ai_towers = {t["lane"]: t for t in match.get("towers", []) if t["side"] == "ai"}
+    left_tower = ai_towers.get("left")
+    tower_by_lane = {2: ai_towers.get("right")}
+    for u in match.get("units", []):
+        idx = u.get("card_idx")
+        if idx is None or idx >= n_cards:
+            # units deployed before card_idx existed (or of a card since removed) resolve by card_id
+            idx = CARD_IDX.get(u["card_id"], -1)
+        u["x"] = u.get("x", 0.0) + speeds[idx] * (dt / 1000.0)
         # basic collision to AI towers when x>10
         if u["x"] >= 10:
-            # hit right lane tower as example
-            for t in match.get("towers", []):
-                if t["side"] == "ai" and (t["lane"] == "right" if u.get("lane",1)==2 else t["lane"] == "left"):
-                    t["hp"] = max(0, t.get("hp", 0) - int(card.get("dmg", 50)))
+            t = tower_by_lane.get(u.get("lane", 1), left_tower)
+            if t is not None:
+                hp, dmg = t.get("hp", 0), dmgs[idx]
+                t["hp"] = hp - dmg if hp > dmg else 0
 
     # countdown
-    new_time = max(0, match.get("time", 0) - int(dt/1000))
-    status = "finished" if new_time == 0 else "active"
+    match["time"] = max(0, match.get("time", 0) - int(dt / 1000))
+    match["status"] = "finished" if match["time"] == 0 else "active"
+    match["last_tick_ms"] = now_ms
 
-    db[COLLECTION_MATCH].update_one(
-        {"_id": match["_id"]},
-        {"$set": {"units": units, "towers": match.get("towers", []), "elixir": new_elixir, "time": new_time, "status": status, "last_tick_ms": now_ms}}
-    )
+async def tick_live_match(match_id: str) -> bool:
+    """Tick a match held in Redis; returns False when the match is not live there"""
+    # the lock serializes ticks within this worker; WATCH on the match hash catches deploys and ticks
+    # from other workers (both bump rev), and the tick is retried on top of their state
+    async with lock_for(match_id):
+        for _ in range(LIVE_TICK_RETRIES):
+            async with redis_db.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(_match_key(match_id))
+                    state = await pipe.hgetall(_match_key(match_id))
+                    units = await pipe.lrange(_units_key(match_id), 0, -1)
+                    match = _parse_live_match(state, units)
+                    if match is None:
+                        return False
+                    await get_cards_map()  # refresh card tables
+                    advance_match(match, int(time.time() * 1000))
+                    pipe.multi()
+                    _queue_live_write(pipe, match_id, match)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        else:
+            raise HTTPException(status_code=409, detail="Match is busy, retry the tick")
+        if match["status"] == "finished":
+            await flush_live_matches([match_id], evict=True)
+    return True
+
+def _card_switch(cards_map: dict[str, dict], field: str, default: float) -> dict:
+    # Inline per-card constants so the pipeline never has to $lookup the card collection
+    branches = [
+        {"case": {"$eq": ["$$u.card_id", card_id]}, "then": card.get(field, default)}
+        for card_id, card in cards_map.items()
+    ]
+    if not branches:
+        return {"$literal": default}
+    return {"$switch": {"branches": branches, "default": default}}
+
+def _card_value(cards_map: dict[str, dict], field: str, default: float) -> dict:
+    # O(1) lookup into the card table by card_idx; $switch on card_id only for units without one
+    table = CARD_SPEEDS if field == "speed" else CARD_DMGS
+    return {"$let": {
+        "vars": {"v": {"$arrayElemAt": [{"$literal": table[:-1]}, "$$u.card_idx"]}},
+        "in": {"$cond": [{"$in": [{"$type": "$$v"}, ["missing", "null"]]}, _card_switch(cards_map, field, default), "$$v"]},
+    }}
+
+def _ai_lane_damage(cards_map: dict[str, dict]) -> dict:
+    # One pass over units accumulating dmg per AI tower lane (lane 2 -> right, else left), instead of
+    # re-filtering the units array once per tower
+    return {
+        "$reduce": {
+            "input": "$units",
+            "initialValue": {"left": 0, "right": 0},
+            "in": {"$let": {
+                "vars": {"u": "$$this"},
+                "in": {"$cond": [
+                    {"$lt": ["$$u.x", 10]},
+                    "$$value",
+                    {"$cond": [
+                        {"$eq": [{"$ifNull": ["$$u.lane", 1]}, 2]},
+                        {"left": "$$value.left", "right": {"$add": ["$$value.right", {"$toInt": _card_value(cards_map, "dmg", 50)}]}},
+                        {"left": {"$add": ["$$value.left", {"$toInt": _card_value(cards_map, "dmg", 50)}]}, "right": "$$value.right"},
+                    ]},
+                ]},
+            }},
+        }
+    }
+
+# Mongo's clock is authoritative for ticks, so replicas with skewed clocks agree on elapsed time
+_NOW_MS = {"$toLong": "$$NOW"}
+
+def tick_pipeline(cards_map: dict[str, dict], now_ms=_NOW_MS) -> list:
+    """Aggregation-pipeline update advancing a match by the time elapsed since its last tick
+
+    now_ms defaults to Mongo's clock; a fixed value lets tests compare against advance_match.
+    """
+    return [
+        {"$set": {"_dt_ms": {"$max": [0, {"$subtract": [now_ms, {"$ifNull": ["$last_tick_ms", now_ms]}]}]}}},
+        {"$set": {
+            # simple movement
+            "units": {
+                "$map": {
+                    "input": {"$ifNull": ["$units", []]},
+                    "as": "u",
+                    "in": {"$mergeObjects": ["$$u", {"x": {"$add": [
+                        {"$ifNull": ["$$u.x", 0.0]},
+                        {"$multiply": [_card_value(cards_map, "speed", 1.0), {"$divide": ["$_dt_ms", 1000.0]}]},
+                    ]}}]},
+                }
+            },
+            # regen elixir: 1 elixir per 2800ms up to 10
+            "elixir": {"$min": [10, {"$add": [{"$ifNull": ["$elixir", 0]}, {"$divide": ["$_dt_ms", 2800.0]}]}]},
+            # countdown
+            "time": {"$max": [0, {"$subtract": [{"$ifNull": ["$time", 0]}, {"$trunc": {"$divide": ["$_dt_ms", 1000]}}]}]},
+            "last_tick_ms": now_ms,
+        }},
+        {"$set": {"_lane_dmg": _ai_lane_damage(cards_map)}},
+        {"$set": {
+            # basic collision to AI towers when x>10
+            "towers": {
+                "$map": {
+                    "input": {"$ifNull": ["$towers", []]},
+                    "as": "t",
+                    "in": {"$switch": {
+                        "branches": [
+                            {
+                                "case": {"$and": [{"$eq": ["$$t.side", "ai"]}, {"$eq": ["$$t.lane", lane_key]}]},
+                                "then": {"$mergeObjects": ["$$t", {"hp": {"$max": [0, {"$subtract": [{"$ifNull": ["$$t.hp", 0]}, f"$_lane_dmg.{lane_key}"]}]}}]},
+                            }
+                            for lane_key in ("left", "right")
+                        ],
+                        "default": "$$t",
+                    }},
+                }
+            },
+            "status": {"$cond": [{"$eq": ["$time", 0]}, "finished", "active"]},
+        }},
+        {"$unset": ["_dt_ms", "_lane_dmg"]},
+    ]
+
+async def get_tick_pipeline() -> list:
+    """tick_pipeline specialized to the current card catalog; rebuilt only when the catalog refreshes"""
+    global _TICK_PIPELINE
+    cards_map = await get_cards_map()
+    if _TICK_PIPELINE is None:
+        _TICK_PIPELINE = tick_pipeline(cards_map)
+    return _TICK_PIPELINE
+
+# Ticks arriving within the batch window are coalesced into one bulk_write
+TICK_BATCH_WINDOW_S = 0.005
+_tick_queue: list[tuple[ObjectId, asyncio.Future]] = []
+_tick_task: Optional[asyncio.Task] = None
+
+async def _flush_ticks():
+    global _tick_queue, _tick_task
+    await asyncio.sleep(TICK_BATCH_WINDOW_S)
+    batch, _tick_queue = _tick_queue, []
+    _tick_task = None
+    try:
+        coll = db[COLLECTION_MATCH]
+        oids = list({match_oid for match_oid, _ in batch})
+        # Advance simple simulation: move player units towards AI side and deduct time, regen elixir
+        pipeline = await get_tick_pipeline()
+        result = await coll.bulk_write([UpdateOne({"_id": match_oid}, pipeline) for match_oid in oids], ordered=False)
+        found = set(oids)
+        if result.matched_count < len(oids):
+            # only pay for the existence lookup when some id didn't match, to tell which ones 404
+            found = {d["_id"] async for d in coll.find({"_id": {"$in": oids}}, {"_id": 1})}
+        for match_oid, fut in batch:
+            if not fut.done():
+                fut.set_result(match_oid in found)
+    except Exception as e:
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+
+@app.post("/match/tick/{match_id}")
+async def tick(match_id: str):
+    global _tick_task
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if redis_db is not None and await tick_live_match(match_id):
+        return {"ok": True}
+    fut = asyncio.get_running_loop().create_future()
+    _tick_queue.append((oid(match_id), fut))
+    if _tick_task is None:
+        _tick_task = asyncio.create_task(_flush_ticks())
+    if not await fut:
+        raise HTTPException(status_code=404, detail="Match not found")
     return {"ok": True}
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools")
@@ -32,6 +32,7 @@ class Card(BaseModel):
     dmg: int = Field(..., ge=0)
     speed: float = Field(1.0, ge=0.2, le=5.0, description="Tiles per tick")
     range: float = Field(1.0, ge=0.5, le=5.0)
+    idx: Optional[int] = Field(None, ge=0, description="Stable small-int index assigned at seed time")
 
 # Unit instance on the board
 class Unit(BaseModel):
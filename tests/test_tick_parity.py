@@ -0,0 +1,96 @@
+"""
+Tick parity: the Redis path (advance_match) and the Mongo path (tick_pipeline) encode the same
+game rules twice, so run both on the same match and compare the results.
+
+Needs a MongoDB to run the pipeline against; set TEST_DATABASE_URL to enable.
+"""
+
+import copy
+import os
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("motor")
+pytest.importorskip("redis")
+pytest.importorskip("orjson")
+pymongo = pytest.importorskip("pymongo")
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+
+import main  # noqa: E402
+
+CARDS = {
+    "knight": {"card_id": "knight", "idx": 0, "speed": 1.0, "dmg": 75},
+    "archer": {"card_id": "archer", "idx": 1, "speed": 1.0, "dmg": 100},
+    "giant": {"card_id": "giant", "idx": 2, "speed": 0.6, "dmg": 100},
+    "assassin": {"card_id": "assassin", "idx": 3, "speed": 1.5, "dmg": 200},
+}
+
+START_MS = 1_000_000
+
+
+def _unit(card_id, lane, x, with_idx=True):
+    unit = {"owner": "player", "card_id": card_id, "x": x, "lane": lane, "hp": 100}
+    if with_idx and card_id in CARDS:
+        unit["card_idx"] = CARDS[card_id]["idx"]
+    return unit
+
+
+def _match(time_left):
+    return {
+        "player_id": "p1",
+        "status": "active",
+        "time": time_left,
+        "elixir": 5,
+        "last_tick_ms": START_MS,
+        "towers": [t.copy() for t in main._DEFAULT_TOWERS],
+        "units": [
+            _unit("knight", 0, 9.5),  # crosses x=10 in lane 0 -> left tower
+            _unit("assassin", 1, 8.0),  # crosses x=10 in lane 1 -> left tower
+            _unit("giant", 2, 9.0),  # crosses x=10 in lane 2 -> right tower
+            _unit("archer", 2, 12.0),  # already past x=10
+            _unit("archer", 0, 9.9, with_idx=False),  # predates card_idx, resolved by card_id
+            _unit("wizard", 2, 9.8),  # unknown card, default speed/dmg
+            _unit("knight", 1, 0.0),  # does not reach the towers
+        ],
+    }
+
+
+@pytest.fixture
+def collection():
+    client = pymongo.MongoClient(TEST_DATABASE_URL)
+    coll = client["tick_parity_test"]["match"]
+    coll.drop()
+    yield coll
+    coll.drop()
+    client.close()
+
+
+@pytest.fixture(autouse=True)
+def card_tables():
+    main.load_card_tables(CARDS)
+
+
+@pytest.mark.parametrize("time_left, dt_ms", [(180, 2500), (2, 2500), (60, 0)])
+def test_advance_match_matches_tick_pipeline(collection, time_left, dt_ms):
+    now_ms = START_MS + dt_ms
+    match = _match(time_left)
+
+    expected = copy.deepcopy(match)
+    main.advance_match(expected, now_ms)
+
+    match_id = collection.insert_one(copy.deepcopy(match)).inserted_id
+    collection.update_one({"_id": match_id}, main.tick_pipeline(CARDS, now_ms=now_ms))
+    actual = collection.find_one({"_id": match_id})
+
+    assert {(t["side"], t["lane"]): t["hp"] for t in actual["towers"]} == {
+        (t["side"], t["lane"]): t["hp"] for t in expected["towers"]
+    }
+    assert actual["elixir"] == pytest.approx(expected["elixir"])
+    assert actual["time"] == expected["time"]
+    assert actual["status"] == expected["status"]
+    assert actual["last_tick_ms"] == expected["last_tick_ms"]
+    assert [u["x"] for u in actual["units"]] == pytest.approx([u["x"] for u in expected["units"]])
+    assert "_dt_ms" not in actual and "_lane_dmg" not in actual